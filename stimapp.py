@@ -1,30 +1,163 @@
 import os
-import openai
+import asyncio
+import hashlib
+import json
+import logging
+import queue
+import re
+import threading
+import time
+import litellm
+import tiktoken
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
 import sqlite3
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import StaticPool
 from dotenv import load_dotenv
+from openai import OpenAI
 
 ##############################################################################
 # 1. CONFIGURATION
 ##############################################################################
 
+logger = logging.getLogger(__name__)
+
 # Make sure you have the openai package installed: pip install openai
 # And streamlit: pip install streamlit
 # Then run with: streamlit run streamlit_app.py
 
-# Set your OpenAI API key (recommended: set as environment variable)
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY") 
-# If you have not set the key as an env variable,
-# replace "YOUR_OPENAI_KEY_HERE" with your actual key, or do:
-# openai.api_key = "sk-XXXX..."
+# Set your OpenAI API key (recommended: set as environment variable or in .env).
+# If you have not set the key as an env variable, enter it in the app.
+@st.cache_resource
+def load_api_key():
+    # litellm already calls load_dotenv() when it is imported, so .env is
+    # parsed at import time regardless; this call only keeps .env support
+    # explicit should that change. st.cache_resource just avoids repeating it
+    # on every Streamlit rerun.
+    load_dotenv()
+    return os.getenv("OPENAI_API_KEY")
 
 ##############################################################################
 # 2. DEMO DATABASE SETUP (SQLite in-memory)
 ##############################################################################
 
+# The demo DB is ephemeral, so durability settings only cost time
+SQLITE_PRAGMAS = """
+PRAGMA journal_mode=MEMORY;
+PRAGMA synchronous=OFF;
+PRAGMA temp_store=MEMORY;
+PRAGMA cache_size=-65536;
+PRAGMA mmap_size=268435456;
+"""
+
+DEMO_DB_SCHEMA = """
+CREATE TABLE works (
+    work_id INTEGER PRIMARY KEY,
+    title TEXT,
+    created_year INTEGER
+);
+
+CREATE TABLE contributors (
+    contributor_id INTEGER PRIMARY KEY,
+    name TEXT,
+    is_publisher BOOLEAN
+);
+
+-- Many-to-many table for works <-> contributors (to handle co-writers, etc.)
+CREATE TABLE work_contributors (
+    work_id INTEGER,
+    contributor_id INTEGER,
+    share_percentage REAL,
+    FOREIGN KEY(work_id) REFERENCES works(work_id),
+    FOREIGN KEY(contributor_id) REFERENCES contributors(contributor_id)
+);
+
+CREATE TABLE royalties (
+    royalty_id INTEGER PRIMARY KEY,
+    work_id INTEGER,
+    amount NUMERIC,
+    period_start TEXT,
+    period_end TEXT,
+    FOREIGN KEY(work_id) REFERENCES works(work_id)
+);
+
+-- Royalty totals per work, precomputed at seed time so the common "total
+-- royalties per work" questions skip the join + GROUP BY. The primary key
+-- doubles as the index on work_id.
+CREATE TABLE royalties_by_work (
+    work_id INTEGER PRIMARY KEY,
+    total_amount NUMERIC,
+    first_period TEXT,
+    last_period TEXT,
+    FOREIGN KEY(work_id) REFERENCES works(work_id)
+);
+"""
+
+# Demo data, inserted with one prepared statement per table (executemany)
+WORKS_ROWS = [
+    {"work_id": 1, "title": "Dancing Queen", "created_year": 1976},
+    {"work_id": 2, "title": "Mamma Mia", "created_year": 1975},
+    {"work_id": 3, "title": "Fernando", "created_year": 1976},
+    {"work_id": 4, "title": "Waterloo", "created_year": 1974},
+]
+
+CONTRIBUTORS_ROWS = [
+    {"contributor_id": 101, "name": "Benny Andersson", "is_publisher": 0},
+    {"contributor_id": 102, "name": "Björn Ulvaeus", "is_publisher": 0},
+    {"contributor_id": 103, "name": "Polar Music", "is_publisher": 1},
+    {"contributor_id": 104, "name": "ABBA Manager", "is_publisher": 1},
+]
+
+# Work-Contributors (splits)
+WORK_CONTRIBUTORS_ROWS = [
+    {"work_id": 1, "contributor_id": 101, "share_percentage": 50.0},
+    {"work_id": 1, "contributor_id": 102, "share_percentage": 50.0},
+    {"work_id": 2, "contributor_id": 101, "share_percentage": 40.0},
+    {"work_id": 2, "contributor_id": 102, "share_percentage": 40.0},
+    {"work_id": 2, "contributor_id": 103, "share_percentage": 20.0},
+    {"work_id": 3, "contributor_id": 101, "share_percentage": 33.33},
+    {"work_id": 3, "contributor_id": 102, "share_percentage": 33.33},
+    {"work_id": 3, "contributor_id": 103, "share_percentage": 33.34},
+    {"work_id": 4, "contributor_id": 101, "share_percentage": 25.0},
+    {"work_id": 4, "contributor_id": 102, "share_percentage": 25.0},
+    {"work_id": 4, "contributor_id": 103, "share_percentage": 25.0},
+    {"work_id": 4, "contributor_id": 104, "share_percentage": 25.0},
+]
+
+ROYALTIES_ROWS = [
+    {"royalty_id": 1001, "work_id": 1, "amount": 1500.00, "period_start": "2022-01-01", "period_end": "2022-06-30"},
+    {"royalty_id": 1002, "work_id": 1, "amount": 1700.00, "period_start": "2022-07-01", "period_end": "2022-12-31"},
+    {"royalty_id": 1003, "work_id": 2, "amount": 2200.00, "period_start": "2022-01-01", "period_end": "2022-12-31"},
+    {"royalty_id": 1004, "work_id": 3, "amount": 1800.00, "period_start": "2022-01-01", "period_end": "2022-06-30"},
+    {"royalty_id": 1005, "work_id": 3, "amount": 1900.00, "period_start": "2022-07-01", "period_end": "2022-12-31"},
+    {"royalty_id": 1006, "work_id": 4, "amount": 3000.00, "period_start": "2022-01-01", "period_end": "2022-12-31"},
+]
+
+DEMO_DB_INSERTS = [
+    ("INSERT INTO works (work_id, title, created_year) "
+     "VALUES (:work_id, :title, :created_year)", WORKS_ROWS),
+    ("INSERT INTO contributors (contributor_id, name, is_publisher) "
+     "VALUES (:contributor_id, :name, :is_publisher)", CONTRIBUTORS_ROWS),
+    ("INSERT INTO work_contributors (work_id, contributor_id, share_percentage) "
+     "VALUES (:work_id, :contributor_id, :share_percentage)", WORK_CONTRIBUTORS_ROWS),
+    ("INSERT INTO royalties (royalty_id, work_id, amount, period_start, period_end) "
+     "VALUES (:royalty_id, :work_id, :amount, :period_start, :period_end)", ROYALTIES_ROWS),
+]
+
+# Runs after the demo data is inserted
+DEMO_DB_AGGREGATES = """
+INSERT INTO royalties_by_work (work_id, total_amount, first_period, last_period)
+SELECT work_id, SUM(amount), MIN(period_start), MAX(period_end)
+FROM royalties
+GROUP BY work_id
+"""
+
+
+
+@st.cache_resource
 def create_demo_db():
     """
     Creates an in-memory SQLite database with mock STIM-like tables:
@@ -32,115 +165,320 @@ def create_demo_db():
       - contributors
       - royalties
       - (optional) work_contributors for multi-writer splits
+      - royalties_by_work, precomputed royalty totals per work
 
-    Returns a SQLAlchemy engine connected to this in-memory DB.
+    Returns a SQLAlchemy engine connected to this in-memory DB. The engine is
+    cached with st.cache_resource, so the schema and seed rows are built once
+    per process instead of on every Streamlit rerun.
     """
-    # Create in-memory SQLite engine
-    engine = create_engine("sqlite://", echo=False)
+    # Create in-memory SQLite engine. StaticPool keeps a single shared
+    # connection alive, otherwise every new connection would see an empty DB.
+    engine = create_engine(
+        "sqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+        echo=False,
+    )
 
-    # Create tables
-    with engine.connect() as conn:
-        conn.execute(text("""
-            CREATE TABLE works (
-                work_id INTEGER PRIMARY KEY,
-                title TEXT,
-                created_year INTEGER
-            )
-        """))
-        
-        conn.execute(text("""
-            CREATE TABLE contributors (
-                contributor_id INTEGER PRIMARY KEY,
-                name TEXT,
-                is_publisher BOOLEAN
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        dbapi_connection.executescript(SQLITE_PRAGMAS)
+
+    # Create tables, then insert the demo data. The sqlite3 driver only
+    # accepts one statement per execute(), so the DDL script goes through
+    # executescript() on the underlying DBAPI connection; executescript()
+    # commits any pending transaction and runs the DDL in autocommit mode.
+    # Only the INSERTs (each table's rows bound to a single prepared INSERT
+    # via executemany) and the aggregate share the engine.begin() transaction.
+    with engine.begin() as conn:
+        conn.connection.executescript(DEMO_DB_SCHEMA)
+        for insert_sql, rows in DEMO_DB_INSERTS:
+            conn.execute(text(insert_sql), rows)
+        conn.execute(text(DEMO_DB_AGGREGATES))
+        # The engine is shared by every session for the life of the process,
+        # so generated SQL must not be able to modify or drop the demo data
+        conn.exec_driver_sql("PRAGMA query_only=ON")
+
+    return engine
+
+
+# Tables described to the LLM, in prompt order
+SCHEMA_TABLES = ("works", "contributors", "work_contributors", "royalties", "royalties_by_work")
+
+# Extra hints appended to a table's description
+SCHEMA_TABLE_NOTES = {
+    "royalties_by_work": "precomputed all-time SUM(amount), MIN(period_start), MAX(period_end) "
+                         "of royalties per work, with no per-period breakdown; use it only for "
+                         "all-time totals per work. Questions filtered by year, date or period "
+                         "must aggregate the royalties table instead",
+}
+
+
+@st.cache_resource
+def build_schema_text(_engine) -> str:
+    """
+    Describes SCHEMA_TABLES and their foreign-key relationships by reflecting
+    the engine, so the prompt always matches the actual schema. Like
+    create_demo_db, this is cached with st.cache_resource, so reflection runs
+    once per process and the string is byte-identical across reruns, which
+    keeps the prompt prefix stable for provider-side prompt caching. The
+    engine is not hashed; there is only ever the one cached demo engine.
+    """
+    inspector = inspect(_engine)
+    lines = ["", "Tables:", ""]
+    relationships = []
+    for i, table in enumerate(SCHEMA_TABLES, start=1):
+        column_defs = []
+        for column in inspector.get_columns(table):
+            column_def = f"    {column['name']} {column['type']}"
+            if column["primary_key"]:
+                column_def += " PRIMARY KEY"
+            column_defs.append(column_def)
+        lines.append(f"{i}) {table}(")
+        lines.append(",\n".join(column_defs))
+        if table in SCHEMA_TABLE_NOTES:
+            lines.append(f") -- {SCHEMA_TABLE_NOTES[table]}")
+        else:
+            lines.append(")")
+        lines.append("")
+
+        primary_key = inspector.get_pk_constraint(table)["constrained_columns"]
+        for fk in inspector.get_foreign_keys(table):
+            cardinality = "1-to-1" if fk["constrained_columns"] == primary_key else "1-to-many"
+            relationships.append(
+                f"- {fk['referred_table']} <-> {table}: {cardinality} "
+                f"({table}.{', '.join(fk['constrained_columns'])} -> "
+                f"{fk['referred_table']}.{', '.join(fk['referred_columns'])})"
             )
-        """))
-        
-        # Many-to-many table for works <-> contributors (to handle co-writers, etc.)
+
+    lines.append("Relationships:")
+    lines.extend(relationships)
+    return "\n".join(lines) + "\n"
+
+
+def _sql_query_hash(sql_code: str) -> str:
+    # Only whitespace is normalized; lowercasing would also fold string
+    # literals ('Dancing Queen' vs 'dancing queen') and merge distinct queries
+    normalized_sql = re.sub(r"\s+", " ", sql_code.strip())
+    return hashlib.blake2b(normalized_sql.encode()).hexdigest()
+
+
+# A single SELECT statement, optionally with a WITH clause and leading comments
+_READ_ONLY_SQL_RE = re.compile(r"^\s*(?:--[^\n]*\n\s*|/\*.*?\*/\s*)*(?:SELECT|WITH)\b", re.IGNORECASE | re.DOTALL)
+
+
+def _is_read_only_sql(sql_code: str) -> bool:
+    return bool(_READ_ONLY_SQL_RE.match(sql_code))
+
+
+# Only the first chunk of a result set is materialized and displayed
+MAX_RESULT_ROWS = 10_000
+
+
+@st.cache_data(ttl=600, max_entries=32)
+def run_sql(query_hash: str, _sql_code: str, _engine):
+    """
+    Executes a query against the demo DB. Results are memoized by the hash of
+    the whitespace-normalized SQL, so re-running the same query (or the same
+    SQL generated for a reworded question) skips execution entirely.
+
+    Returns (df, arrow_table, numeric_cols, truncated) where df holds at most
+    MAX_RESULT_ROWS rows, arrow_table is the same data as a pyarrow Table
+    ready for st.dataframe, numeric_cols is a tuple of the numeric column
+    names and truncated tells whether the query produced more rows. The Arrow
+    table and the column list are computed once here rather than on every
+    rerun. Each entry holds the data twice (DataFrame and Arrow), so the
+    cache is capped at 32 entries.
+
+    Anything other than a SELECT (optionally with WITH) is rejected; the demo
+    DB is additionally set to query_only, which also blocks WITH ... DELETE.
+    """
+    if not _is_read_only_sql(_sql_code):
+        raise ValueError("Only SELECT queries can be run against the demo database.")
+    with _engine.connect() as conn:
+        result = conn.execute(text(_sql_code))
+        columns = list(result.keys())
+        rows = result.fetchmany(MAX_RESULT_ROWS + 1)
+    truncated = len(rows) > MAX_RESULT_ROWS
+    df = pd.DataFrame.from_records(rows[:MAX_RESULT_ROWS], columns=columns, coerce_float=True)
+    arrow_table = pa.Table.from_pandas(df, preserve_index=False)
+    numeric_cols = tuple(df.select_dtypes(include="number").columns)
+    return df, arrow_table, numeric_cols, truncated
+
+##############################################################################
+# 3. LLM (OpenAI) HELPER: GENERATE SQL FROM USER QUERY
+##############################################################################
+
+class PromptTooLongError(ValueError):
+    """Raised before calling the API when a prompt exceeds MAX_PROMPT_TOKENS."""
+
+
+# On-disk cache (question + schema -> SQL), shared across processes and
+# filled by both the interactive path and the batch path
+SQL_CACHE_URL = "sqlite:///sql_cache.sqlite"
+# Cached SQL older than this (in seconds) is ignored and regenerated
+SQL_CACHE_TTL = 3600
+
+
+@st.cache_resource
+def create_sql_cache_db():
+    """
+    Opens (and creates if needed) the on-disk SQL cache. This lives in its own
+    file-backed SQLite DB rather than in the in-memory demo DB, which would
+    lose the cache on every restart and expose it to the LLM's schema.
+    """
+    engine = create_engine(SQL_CACHE_URL, connect_args={"check_same_thread": False}, echo=False)
+    with engine.begin() as conn:
         conn.execute(text("""
-            CREATE TABLE work_contributors (
-                work_id INTEGER,
-                contributor_id INTEGER,
-                share_percentage REAL,
-                FOREIGN KEY(work_id) REFERENCES works(work_id),
-                FOREIGN KEY(contributor_id) REFERENCES contributors(contributor_id)
+            CREATE TABLE IF NOT EXISTS sql_cache (
+                question_hash TEXT PRIMARY KEY,
+                sql TEXT,
+                created REAL
             )
         """))
-        
-        conn.execute(text("""
-            CREATE TABLE royalties (
-                royalty_id INTEGER PRIMARY KEY,
-                work_id INTEGER,
-                amount NUMERIC,
-                period_start TEXT,
-                period_end TEXT,
-                FOREIGN KEY(work_id) REFERENCES works(work_id)
+        # Cache files written before the created column existed
+        columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(sql_cache)")}
+        if "created" not in columns:
+            conn.exec_driver_sql("ALTER TABLE sql_cache ADD COLUMN created REAL")
+    return engine
+
+
+def _sql_cache_key(user_question: str, schema_description: str) -> str:
+    # Keyed on the full system prompt (which embeds the schema) so SQL
+    # generated under one prompt variant is never served for another
+    system_prompt, _ = _build_system_prompt(schema_description)
+    return hashlib.blake2b((system_prompt + user_question).encode(), digest_size=16).hexdigest()
+
+
+def _read_sql_cache(cache_key: str):
+    # The cache is best-effort: an unwritable directory or a locked file
+    # must not break queries, so errors are logged and treated as a miss
+    try:
+        with create_sql_cache_db().connect() as conn:
+            return conn.execute(
+                text("SELECT sql FROM sql_cache "
+                     "WHERE question_hash = :question_hash AND created > :min_created"),
+                {"question_hash": cache_key, "min_created": time.time() - SQL_CACHE_TTL}
+            ).scalar()
+    except SQLAlchemyError as e:
+        logger.warning("Could not read the SQL cache: %s", e)
+        return None
+
+
+def _write_sql_cache(rows: list) -> None:
+    # rows: [{"question_hash": ..., "sql": ...}, ...]; empty SQL is never stored.
+    # Best-effort like _read_sql_cache: failures are logged, not raised.
+    rows = [row for row in rows if row["sql"]]
+    if not rows:
+        return
+    created = time.time()
+    try:
+        with create_sql_cache_db().begin() as conn:
+            conn.execute(
+                text("INSERT OR REPLACE INTO sql_cache (question_hash, sql, created) "
+                     "VALUES (:question_hash, :sql, :created)"),
+                [{**row, "created": created} for row in rows]
             )
-        """))
+    except SQLAlchemyError as e:
+        logger.warning("Could not write to the SQL cache: %s", e)
 
-        # Insert some demo data
-        # Works
-        conn.execute(text("""
-            INSERT INTO works (work_id, title, created_year)
-            VALUES
-            (1, 'Dancing Queen', 1976),
-            (2, 'Mamma Mia', 1975),
-            (3, 'Fernando', 1976),
-            (4, 'Waterloo', 1974)
-        """))
-        
-        # Contributors
-        conn.execute(text("""
-            INSERT INTO contributors (contributor_id, name, is_publisher)
-            VALUES
-            (101, 'Benny Andersson', 0),
-            (102, 'Björn Ulvaeus', 0),
-            (103, 'Polar Music', 1),
-            (104, 'ABBA Manager', 1)
-        """))
-        
-        # Work-Contributors (splits)
-        conn.execute(text("""
-            INSERT INTO work_contributors (work_id, contributor_id, share_percentage)
-            VALUES
-            (1, 101, 50.0),
-            (1, 102, 50.0),
-            (2, 101, 40.0),
-            (2, 102, 40.0),
-            (2, 103, 20.0),
-            (3, 101, 33.33),
-            (3, 102, 33.33),
-            (3, 103, 33.34),
-            (4, 101, 25.0),
-            (4, 102, 25.0),
-            (4, 103, 25.0),
-            (4, 104, 25.0)
-        """))
-        
-        # Royalties
-        conn.execute(text("""
-            INSERT INTO royalties (royalty_id, work_id, amount, period_start, period_end)
-            VALUES
-            (1001, 1, 1500.00, '2022-01-01', '2022-06-30'),
-            (1002, 1, 1700.00, '2022-07-01', '2022-12-31'),
-            (1003, 2, 2200.00, '2022-01-01', '2022-12-31'),
-            (1004, 3, 1800.00, '2022-01-01', '2022-06-30'),
-            (1005, 3, 1900.00, '2022-07-01', '2022-12-31'),
-            (1006, 4, 3000.00, '2022-01-01', '2022-12-31')
-        """))
 
-    return engine
+@st.cache_resource
+def _token_encoding():
+    # Tokenizer for the chat model, loaded lazily and once per process (a
+    # failed load is cached too, so reruns don't retry the download).
+    # tiktoken downloads its BPE file on first use, so this must not run at
+    # import time; returns None when the encoding cannot be loaded (e.g. no
+    # network), in which case padding and the length check are skipped.
+    try:
+        return tiktoken.encoding_for_model("gpt-3.5-turbo")
+    except (OSError, ValueError) as e:
+        # Network and file errors (requests' exceptions are OSErrors) or a
+        # corrupt download (ValueError on hash mismatch)
+        logger.warning(
+            "Could not load the tiktoken encoding (%s); prompts will be sent "
+            "without the %s-token length check", e, f"{MAX_PROMPT_TOKENS:,}"
+        )
+        return None
 
-##############################################################################
-# 3. LLM (OpenAI) HELPER: GENERATE SQL FROM USER QUERY
-##############################################################################
-from openai import OpenAI
+# OpenAI only caches prompt prefixes of at least this many tokens
+PROMPT_CACHE_MIN_TOKENS = 1024
+# Prompts above this size are rejected before any request is made
+MAX_PROMPT_TOKENS = 14_000
 
-def generate_sql_query(user_question: str, schema_description: str, api_key: str) -> str:
-    client = OpenAI(api_key=api_key)
-    
-    prompt = f"""
-You are an expert SQL generator. Generate a query following this structure:
+# SQLite dialect and schema notes, always part of the system prompt
+SQL_STYLE_NOTES = """
+SQL style notes (SQLite dialect):
+- The database is SQLite. Use only functions SQLite supports: SUM, COUNT, AVG,
+  MIN, MAX, ROUND, COALESCE, IFNULL, NULLIF, CAST, SUBSTR, LOWER, UPPER, TRIM,
+  LENGTH, REPLACE, strftime, date, julianday.
+- There is no YEAR() or EXTRACT(); use strftime('%Y', column) to get a year as
+  text, or CAST(strftime('%Y', column) AS INTEGER) to compare it with a number.
+- Dates are stored as ISO-8601 text (YYYY-MM-DD), so they compare correctly
+  as strings: period_start >= '2022-01-01' AND period_end <= '2022-12-31'.
+- Booleans are stored as 0 and 1; filter with column = 1 or column = 0.
+- Use single quotes for string literals and double quotes only for
+  identifiers that need quoting.
+- Qualify every column with its table or CTE alias as soon as more than one
+  table is involved, and give every output column a readable alias.
+- Prefer explicit JOIN ... ON over comma joins. Use LEFT JOIN when rows
+  without a match must still appear (e.g. works with no royalties).
+- Every non-aggregated column in the SELECT list must appear in GROUP BY.
+- Put filters on raw rows in WHERE and filters on aggregates in HAVING.
+- When splitting royalties between contributors, multiply the amount by
+  share_percentage / 100.0 to avoid integer division.
+- Add ORDER BY for any result the user will read as a ranking or a list, and
+  LIMIT only when the question asks for a top-N.
+- Do not modify data: never emit INSERT, UPDATE, DELETE, DROP, ALTER or
+  CREATE statements. Produce a single SELECT statement (optionally with WITH).
+- works holds one row per musical work: title is its name and created_year
+  the year it was written.
+- contributors lists both songwriters and publishers; is_publisher = 1 marks
+  a publisher and is_publisher = 0 a songwriter.
+- work_contributors links works to contributors. share_percentage is the
+  contributor's share of that work's royalties; the shares of one work add up
+  to 100.
+- royalties holds one row per work and payout period; amount is the royalty
+  paid for the period from period_start to period_end.
+- For royalties per contributor, join royalties to work_contributors on
+  work_id and sum amount * share_percentage / 100.0 grouped by contributor.
+- Use COUNT(DISTINCT ...) when counting works or contributors across joins
+  that can repeat rows.
+- Users may not type exact capitalization: match titles and names with
+  LOWER(column) = LOWER('value'), or LIKE '%text%' for partial matches
+  (SQLite's LIKE is case-insensitive for ASCII letters).
+- Wrap divisors in NULLIF(divisor, 0) so a zero divisor yields NULL instead
+  of an error.
+- When the question is about specific works or people, return readable
+  columns (work title, contributor name) and not only their ids.
+- Compute shares and ratios as REAL values (e.g. multiply by 1.0) so SQLite
+  does not truncate them with integer division.
+"""
+
+# Background text with no bearing on the SQL, appended (whole, once) when
+# the system prompt is shorter than PROMPT_CACHE_MIN_TOKENS so the prefix
+# becomes eligible for provider-side prompt caching
+PROMPT_PADDING = """
+Background (context only, no additional instructions):
+This prompt belongs to the STIM Query Assistant, a demo application in which
+people type questions about a music catalog in plain language and receive the
+answer as a table. STIM is the Swedish collecting society for music creators
+and publishers; it licenses the use of its members' music and distributes the
+resulting royalties to songwriters, composers and publishers. The demo runs
+against a small mock database with a handful of works, contributors and
+royalty payments, and every query is executed read-only. The generated SQL is
+shown to the user next to the results so that they can check how the answer
+was computed, and the numeric columns of each result are plotted as a bar
+chart. Questions are typically about which works someone contributed to, how
+the shares of a work are split, and how much a work or a contributor earned.
+"""
+
+
+# Prompt templates, filled with str.format_map. {padding} receives
+# PROMPT_PADDING or nothing, as chosen by _build_system_prompt.
+_SYSTEM_PROMPT_TMPL = """You are an expert SQL query generator that produces clean, structured queries without any markdown formatting.
+
+Generate a query following this structure:
 
 WITH
 -- Common Table Expressions (CTEs) for complex subqueries
@@ -166,27 +504,226 @@ GROUP BY columns
 HAVING conditions
 -- Final ordering
 ORDER BY columns;
-
+{notes}{padding}
 Schema:
-{schema_description}
-
-User question: {user_question}
+{schema}
 
 Return ONLY the raw SQL query, no markdown formatting, no ```sql tags, no backticks."""
 
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are an expert SQL query generator that produces clean, structured queries without any markdown formatting."},
-            {"role": "user", "content": prompt}
+_USER_PROMPT_TMPL = "User question: {question}"
+
+
+@st.cache_resource
+def _build_system_prompt(schema_description: str):
+    """
+    Builds the static system prompt for a schema and returns
+    (system_prompt, n_tokens), with n_tokens None when no tokenizer is
+    available. SQL_STYLE_NOTES are always included; PROMPT_PADDING is added
+    only when the prompt is shorter than PROMPT_CACHE_MIN_TOKENS. The result
+    is a pure function of the schema, so it is byte-identical across calls,
+    and st.cache_resource keeps it (and its token count) across reruns.
+    """
+    fields = {"schema": schema_description, "notes": SQL_STYLE_NOTES, "padding": ""}
+    system_prompt = _SYSTEM_PROMPT_TMPL.format_map(fields)
+    encoding = _token_encoding()
+    if encoding is None:
+        return system_prompt, None
+
+    n_tokens = len(encoding.encode(system_prompt))
+    if n_tokens < PROMPT_CACHE_MIN_TOKENS:
+        system_prompt = _SYSTEM_PROMPT_TMPL.format_map({**fields, "padding": PROMPT_PADDING})
+        n_tokens = len(encoding.encode(system_prompt))
+    return system_prompt, n_tokens
+
+
+def _completion_body(user_question: str, schema_description: str) -> dict:
+    # Chat completion payload shared by the interactive and the batch path.
+    # Everything static (instructions, query template, schema) lives in the
+    # system message and only the question goes into the user message, so the
+    # prompt prefix is byte-identical across calls and provider-side prompt
+    # caching can kick in. Keep per-call data (timestamps, ids) out of it.
+    system_prompt, n_tokens = _build_system_prompt(schema_description)
+    user_prompt = _USER_PROMPT_TMPL.format_map({"question": user_question})
+    if n_tokens is not None:
+        n_tokens += len(_token_encoding().encode(user_prompt))
+    if n_tokens is not None and n_tokens > MAX_PROMPT_TOKENS:
+        raise PromptTooLongError(
+            f"The prompt is {n_tokens:,} tokens long (limit {MAX_PROMPT_TOKENS:,}). "
+            "Please shorten your question."
+        )
+
+    return {
+        "model": "gpt-3.5-turbo",
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
         ],
-        temperature=0
+        "temperature": 0
+    }
+
+
+# Markdown code fences (```sql / ```) the model sometimes adds anyway
+_FENCE_RE = re.compile(r"```(?:sql)?")
+
+
+def _clean_sql(content: str) -> str:
+    # Remove any markdown formatting if present, in a single pass
+    return _FENCE_RE.sub("", content).strip()
+
+
+async def generate_sql_query(user_question: str, schema_description: str, api_key: str, on_delta=None) -> str:
+    # on_delta(buffer) is called with the partial SQL after every streamed chunk.
+    # Callers check lookup_cached_sql() first; this always asks the model.
+    # litellm adds a per-request timeout, retries with backoff on rate limits
+    # and 5xx errors, and falls back to another model if the primary one fails.
+    # With stream=True, acompletion honours fallbacks for failures raised
+    # when the request is made, not for errors in the middle of a stream.
+    stream = await litellm.acompletion(
+        **_completion_body(user_question, schema_description),
+        api_key=api_key,
+        stream=True,
+        timeout=15,
+        num_retries=3,
+        fallbacks=[{"model": "gpt-4o-mini"}]
     )
-    
-    sql_code = response.choices[0].message.content.strip()
-    # Remove any markdown formatting if present
-    sql_code = sql_code.replace('```sql', '').replace('```', '')
-    return sql_code.strip()
+
+    buffer = ""
+    async for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            buffer += delta
+            if on_delta is not None:
+                on_delta(buffer)
+
+    # Not cached here: the caller stores it with store_generated_sql() once
+    # the query has actually run
+    return _clean_sql(buffer)
+
+
+@st.cache_resource
+def _llm_event_loop():
+    # One event loop for the whole process, running in a daemon thread.
+    # litellm caches its async HTTP clients at module level, so every call
+    # must run on the same loop; a fresh asyncio.run() per click would leave
+    # those pooled connections bound to a closed loop.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return loop
+
+
+def stream_sql_query(user_question: str, schema_description: str, api_key: str, on_delta=None) -> str:
+    """
+    Runs generate_sql_query on the shared event loop and blocks until it is
+    done. Partial SQL is passed back through a queue, so on_delta (which
+    usually writes to a Streamlit placeholder) runs on the calling script
+    thread rather than on the loop thread.
+    """
+    deltas = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        generate_sql_query(user_question, schema_description, api_key, on_delta=deltas.put),
+        _llm_event_loop()
+    )
+    future.add_done_callback(lambda _: deltas.put(None))
+    while (buffer := deltas.get()) is not None:
+        if on_delta is not None:
+            on_delta(buffer)
+    return future.result()
+
+
+def lookup_cached_sql(user_question: str, schema_description: str):
+    # Returns the cached SQL for this question, or None on a miss
+    return _read_sql_cache(_sql_cache_key(user_question, schema_description))
+
+
+def store_generated_sql(user_question: str, schema_description: str, sql_code: str) -> None:
+    # Only call this on a cache miss: storing again would reset created and
+    # keep frequently asked questions from ever expiring
+    _write_sql_cache([{"question_hash": _sql_cache_key(user_question, schema_description), "sql": sql_code}])
+
+
+def generate_sql_queries_batch(questions: list, schema_description: str, api_key: str, poll_interval: float = 30.0) -> dict:
+    """
+    Generates SQL for many questions through the OpenAI Batch API, e.g. for
+    offline evaluation runs. Batch requests cost half as much as real-time
+    calls and use a separate rate limit, but complete within 24h, so this
+    blocks while polling.
+
+    Results are stored in the sql_cache table so later interactive calls hit
+    the cache; empty or non-SELECT completions are dropped. Questions whose
+    prompt exceeds MAX_PROMPT_TOKENS are logged and skipped, and the rest
+    are still submitted. Returns {question: sql} for every question that
+    succeeded.
+    """
+    results = {}
+    pending = {}
+    for question in questions:
+        cache_key = _sql_cache_key(question, schema_description)
+        cached_sql = _read_sql_cache(cache_key)
+        if cached_sql is not None:
+            results[question] = cached_sql
+        else:
+            pending[cache_key] = question
+    if not pending:
+        return results
+
+    lines = []
+    for cache_key, question in list(pending.items()):
+        try:
+            body = _completion_body(question, schema_description)
+        except PromptTooLongError as e:
+            # Skip just this question rather than failing the whole batch
+            logger.warning("Skipping question %r: %s", question, e)
+            del pending[cache_key]
+            continue
+        lines.append(json.dumps({
+            "custom_id": cache_key,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body
+        }))
+    if not lines:
+        return results
+
+    client = OpenAI(api_key=api_key)
+    batch_file = client.files.create(
+        file=("sql_batch.jsonl", "\n".join(lines).encode()),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} ended with status '{batch.status}'")
+
+    cache_rows = []
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            content = response["body"]["choices"][0]["message"]["content"]
+            if content is None:
+                continue
+            sql_code = _clean_sql(content)
+            if not _is_read_only_sql(sql_code):
+                continue
+            cache_rows.append({"question_hash": record["custom_id"], "sql": sql_code})
+            results[pending[record["custom_id"]]] = sql_code
+
+    # Requests that failed outright go to a separate error file
+    if batch.error_file_id:
+        failed = len(client.files.content(batch.error_file_id).text.splitlines())
+        logger.warning("Batch %s: %d request(s) failed (error file %s)", batch.id, failed, batch.error_file_id)
+
+    _write_sql_cache(cache_rows)
+    return results
 
 
 
@@ -196,7 +733,7 @@ Return ONLY the raw SQL query, no markdown formatting, no ```sql tags, no backti
 def main():
     st.title("STIM Query Assistant")
     
-    api_key = openai.api_key
+    api_key = load_api_key()
     if not api_key:
         api_key = st.text_input("Enter OpenAI API Key:", type="password")
         if not api_key:
@@ -205,40 +742,7 @@ def main():
 
     engine = create_demo_db()
     
-    schema_text = """
-Tables:
-
-1) works(
-    work_id INTEGER PRIMARY KEY,
-    title TEXT,
-    created_year INTEGER
-)
-
-2) contributors(
-    contributor_id INTEGER PRIMARY KEY,
-    name TEXT,
-    is_publisher BOOLEAN
-)
-
-3) work_contributors(
-    work_id INTEGER,
-    contributor_id INTEGER,
-    share_percentage REAL
-)
-
-4) royalties(
-    royalty_id INTEGER PRIMARY KEY,
-    work_id INTEGER,
-    amount NUMERIC,
-    period_start TEXT,
-    period_end TEXT
-)
-
-Relationships:
-- works <-> work_contributors: 1-to-many (one work can have multiple entries in work_contributors)
-- contributors <-> work_contributors: 1-to-many (one contributor can appear on multiple works)
-- works <-> royalties: 1-to-many (one work can have multiple royalty entries)
-"""
+    schema_text = build_schema_text(engine)
 
     st.markdown("""
 **Instructions**:  
@@ -253,25 +757,44 @@ Relationships:
         if not user_query.strip():
             st.warning("Please enter a question before running the query.")
         else:
-            with st.spinner("Generating SQL via OpenAI..."):
-                sql_code = generate_sql_query(user_query, schema_text, api_key)
-            
             st.subheader("Generated SQL Query")
-            st.code(sql_code, language="sql")
-            
-            try:
-                with engine.connect() as conn:
-                    df = pd.read_sql(text(sql_code), conn)
-                st.subheader("Query Results")
-                if df.empty:
-                    st.write("No rows returned.")
+            sql_placeholder = st.empty()
+            sql_code = lookup_cached_sql(user_query, schema_text)
+            from_cache = sql_code is not None
+            if not from_cache:
+                try:
+                    with st.spinner("Generating SQL via OpenAI..."):
+                        sql_code = stream_sql_query(
+                            user_query,
+                            schema_text,
+                            api_key,
+                            on_delta=lambda buffer: sql_placeholder.code(buffer, language="sql"),
+                        )
+                except PromptTooLongError as e:
+                    st.error(str(e))
+
+            if sql_code is not None:
+                sql_placeholder.code(sql_code, language="sql")
+
+                try:
+                    df, arrow_table, numeric_cols, truncated = run_sql(_sql_query_hash(sql_code), sql_code, engine)
+                except Exception as e:
+                    st.error(f"Error executing SQL: {e}")
                 else:
-                    st.dataframe(df)
-                    numeric_cols = df.select_dtypes(include=['int64','float64']).columns
-                    if len(numeric_cols) > 0:
-                        st.bar_chart(df[numeric_cols])
-            except Exception as e:
-                st.error(f"Error executing SQL: {e}")
+                    if not from_cache:
+                        store_generated_sql(user_query, schema_text, sql_code)
+                    st.subheader("Query Results")
+                    if df.empty:
+                        st.write("No rows returned.")
+                    else:
+                        st.dataframe(arrow_table)
+                        if truncated:
+                            st.caption(f"Showing the first {MAX_RESULT_ROWS:,} rows.")
+                        if numeric_cols:
+                            # All columns are numeric, so to_numpy() can usually
+                            # return a view instead of a copy
+                            chart_values = df[list(numeric_cols)].to_numpy(copy=False)
+                            st.bar_chart(pd.DataFrame(chart_values, columns=numeric_cols))
 
     st.markdown("---")
     st.markdown("**Demo database**: This is only a mock in-memory DB with ABBA-themed data. In production, connect to STIM's real schema.")